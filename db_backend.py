@@ -13,9 +13,12 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import io
 import os
+import csv
 import psycopg2
-from pymongo import MongoClient
+from psycopg2.extras import execute_values
+from pymongo import MongoClient, UpdateOne
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -30,24 +33,84 @@ if DB_BACKEND == "postgres":
         "dbname": os.getenv("DB_NAME"),
         "user": os.getenv("DB_USER"),
         "password": os.getenv("DB_PASSWORD"),
+        # Detect dead connections during long scans instead of hanging
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3,
+        "options": "-c tcp_user_timeout=30000",
     }
+    # Optional synchronous_commit for the tracker's session. "off" lets
+    # per-device commits skip the WAL flush wait, at the risk of losing the
+    # last few on a crash; unset keeps the server's setting.
+    DB_SYNCHRONOUS_COMMIT = os.getenv("DB_SYNCHRONOUS_COMMIT")
+    # Batches smaller than this are sent inline instead of via COPY
+    DB_COPY_THRESHOLD = int(os.getenv("DB_COPY_THRESHOLD", 1000))
 elif DB_BACKEND == "mongo":
     MONGO_URI = os.getenv("MONGO_URI")
     MONGO_DB = os.getenv("MONGO_DB")
 else:
     raise ValueError("Invalid DB_BACKEND. Use 'postgres' or 'mongo'.")
 
+# Separators stripped when storing Mongo's normalized MAC
+_MAC_STRIP = str.maketrans("", "", "-:.")
+
+# Records movements and upserts addresses in one statement. Both parts of
+# the CTE see the same snapshot, so the join still reads the old location.
+UPSERT_SQL = """
+    WITH s (mac, device, interface, seen) AS ({source}),
+    moved AS (
+        INSERT INTO mac_movements (mac, from_device, from_if, to_device, to_if, moved_at)
+        SELECT s.mac, m.device, m.interface, s.device, s.interface, s.seen
+        FROM s JOIN mac_addresses m USING (mac)
+        WHERE m.device IS DISTINCT FROM s.device OR m.interface IS DISTINCT FROM s.interface
+    )
+    INSERT INTO mac_addresses (mac, device, interface, first_seen, last_seen)
+    SELECT mac, device, interface, seen, seen FROM s
+    ON CONFLICT (mac) DO UPDATE SET
+        device = EXCLUDED.device,
+        interface = EXCLUDED.interface,
+        last_seen = EXCLUDED.last_seen
+"""
+
 class MACStorage:
-    def __init__(self):
+    def __init__(self, readonly=False):
+        self._pending = []
+        # MACs seen again at their stored location only need last_seen bumped
+        self._touched = []
+        # mac -> (device, interface), loaded on the first upsert
+        self._known = None
+        self._lookups_prepared = False
         if DB_BACKEND == "postgres":
             self.conn = psycopg2.connect(**DB_CONFIG)
+            # Lookups run in autocommit so they never hold locks between queries
+            self.conn.set_session(autocommit=readonly)
             self.cursor = self.conn.cursor()
-            self._ensure_postgres_tables()
+            # Lookups only read, so they leave the schema to the tracker
+            if not readonly:
+                if DB_SYNCHRONOUS_COMMIT:
+                    self.cursor.execute("SET synchronous_commit = %s", (DB_SYNCHRONOUS_COMMIT,))
+                self._ensure_postgres_tables()
         else:
             self.client = MongoClient(MONGO_URI)
             self.db = self.client[MONGO_DB]
             self.mac_coll = self.db["mac_addresses"]
             self.movements = self.db["mac_movements"]
+            if not readonly:
+                self.mac_coll.create_index("mac")
+                self.mac_coll.create_index("mac_norm")
+                self._backfill_mac_norm()
+                self.movements.create_index([("mac", 1), ("moved_at", -1)])
+
+    def _backfill_mac_norm(self):
+        # Documents written before mac_norm existed
+        strip = {"$toLower": "$mac"}
+        for sep in ":-.":
+            strip = {"$replaceAll": {"input": strip, "find": sep, "replacement": ""}}
+        self.mac_coll.update_many(
+            {"mac_norm": {"$exists": False}},
+            [{"$set": {"mac_norm": strip}}]
+        )
 
     def _ensure_postgres_tables(self):
         self.cursor.execute("""
@@ -71,59 +134,180 @@ class MACStorage:
             moved_at TIMESTAMP
         );
         """)
+        # ALTER TABLE and CREATE INDEX lock the table and check ownership
+        # even when IF NOT EXISTS would skip them, so only run them when the
+        # object is actually missing
+        if not self._postgres_relation_exists("mac_movements_mac_moved"):
+            self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS mac_movements_mac_moved
+                ON mac_movements (mac, moved_at DESC);
+            """)
+        # Separator-free MAC for partial lookups, backed by a trigram index
+        self.cursor.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'mac_addresses' AND column_name = 'mac_norm'
+        """)
+        if self.cursor.fetchone() is None:
+            self.cursor.execute("""
+            ALTER TABLE mac_addresses ADD COLUMN IF NOT EXISTS mac_norm TEXT
+                GENERATED ALWAYS AS (regexp_replace(lower(mac), '[-:.]', '', 'g')) STORED;
+            """)
+        if not self._postgres_relation_exists("mac_addresses_mac_norm_trgm"):
+            self.cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            self.cursor.execute("""
+            CREATE INDEX IF NOT EXISTS mac_addresses_mac_norm_trgm
+                ON mac_addresses USING gin (mac_norm gin_trgm_ops);
+            """)
+        # Release the DDL locks instead of holding them for the whole run
+        self.conn.commit()
+
+    def _postgres_relation_exists(self, name):
+        self.cursor.execute("SELECT to_regclass(%s)", (name,))
+        return self.cursor.fetchone()[0] is not None
+
+    def prepare_lookups(self):
+        # Parse and plan mac_lookup's queries once per connection
+        if DB_BACKEND != "postgres" or self._lookups_prepared:
+            return
+        self.cursor.execute("""
+        PREPARE mac_search(text) AS
+        SELECT mac, device, interface, first_seen, last_seen
+        FROM mac_addresses
+        WHERE mac_norm LIKE $1
+        ORDER BY last_seen DESC
+        """)
+        self.cursor.execute("""
+        PREPARE mac_history(text[]) AS
+        SELECT mac, from_device, from_if, to_device, to_if, moved_at
+        FROM mac_movements
+        WHERE mac = ANY($1)
+        ORDER BY mac, moved_at DESC
+        """)
+        self._lookups_prepared = True
 
     def upsert_mac(self, mac, device, interface):
+        self.upsert_macs_bulk(device, [mac], [interface])
+
+    def upsert_macs_bulk(self, device, macs, interfaces):
+        if self._known is None:
+            self._known = self._load_known()
+
+        # Buffered and written in bulk on flush() or commit()
         now = datetime.utcnow()
+        known = self._known
+        for mac, interface in zip(macs, interfaces):
+            if known.get(mac) == (device, interface):
+                self._touched.append(mac)
+            else:
+                self._pending.append((mac, device, interface, now))
 
+    def _load_known(self):
         if DB_BACKEND == "postgres":
-            self.cursor.execute("SELECT device, interface FROM mac_addresses WHERE mac = %s", (mac,))
-            row = self.cursor.fetchone()
-            if row:
-                old_device, old_if = row
-                if old_device == device and old_if == interface:
-                    self.cursor.execute("UPDATE mac_addresses SET last_seen = %s WHERE mac = %s", (now, mac))
-                else:
-                    self.cursor.execute("""
-                        INSERT INTO mac_movements (mac, from_device, from_if, to_device, to_if, moved_at)
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (mac, old_device, old_if, device, interface, now))
-                    self.cursor.execute("""
-                        UPDATE mac_addresses SET device = %s, interface = %s, last_seen = %s WHERE mac = %s
-                    """, (device, interface, now, mac))
+            self.cursor.execute("SELECT mac, device, interface FROM mac_addresses")
+            return {mac: (device, interface) for mac, device, interface in self.cursor}
+        return {
+            d["mac"]: (d.get("device"), d.get("interface"))
+            for d in self.mac_coll.find({}, {"_id": 0, "mac": 1, "device": 1, "interface": 1})
+        }
+
+    def flush(self):
+        if self._touched:
+            touched, self._touched = self._touched, []
+            now = datetime.utcnow()
+            if DB_BACKEND == "postgres":
+                self.cursor.execute(
+                    "UPDATE mac_addresses SET last_seen = %s WHERE mac = ANY(%s)", (now, touched)
+                )
             else:
-                self.cursor.execute("""
-                    INSERT INTO mac_addresses (mac, device, interface, first_seen, last_seen)
-                    VALUES (%s, %s, %s, %s, %s)
-                """, (mac, device, interface, now, now))
+                self.mac_coll.update_many({"mac": {"$in": touched}}, {"$set": {"last_seen": now}})
+
+        if not self._pending:
+            return
+
+        # Last sighting wins if a MAC was reported more than once
+        rows = list({row[0]: row for row in self._pending}.values())
+        self._pending = []
+
+        if DB_BACKEND == "postgres":
+            self._flush_postgres(rows)
         else:
-            existing = self.mac_coll.find_one({"mac": mac})
-            if existing:
-                if existing["device"] == device and existing["interface"] == interface:
-                    self.mac_coll.update_one({"mac": mac}, {"$set": {"last_seen": now}})
-                else:
-                    self.movements.insert_one({
-                        "mac": mac,
-                        "from_device": existing["device"],
-                        "from_if": existing["interface"],
-                        "to_device": device,
-                        "to_if": interface,
-                        "moved_at": now
-                    })
-                    self.mac_coll.update_one({"mac": mac}, {"$set": {
+            self._flush_mongo(rows)
+
+        for mac, device, interface, _ in rows:
+            self._known[mac] = (device, interface)
+
+    def _flush_mongo(self, rows):
+        existing = {
+            d["mac"]: d
+            for d in self.mac_coll.find(
+                {"mac": {"$in": [row[0] for row in rows]}},
+                {"_id": 0, "mac": 1, "device": 1, "interface": 1}
+            )
+        }
+
+        moves, ops = [], []
+        for mac, device, interface, now in rows:
+            old = existing.get(mac)
+            if old and (old.get("device"), old.get("interface")) != (device, interface):
+                moves.append({
+                    "mac": mac,
+                    "from_device": old.get("device"),
+                    "from_if": old.get("interface"),
+                    "to_device": device,
+                    "to_if": interface,
+                    "moved_at": now
+                })
+            ops.append(UpdateOne(
+                {"mac": mac},
+                {
+                    "$setOnInsert": {"first_seen": now},
+                    "$set": {
+                        "mac_norm": mac.lower().translate(_MAC_STRIP),
                         "device": device,
                         "interface": interface,
                         "last_seen": now
-                    }})
-            else:
-                self.mac_coll.insert_one({
-                    "mac": mac,
-                    "device": device,
-                    "interface": interface,
-                    "first_seen": now,
-                    "last_seen": now
-                })
+                    }
+                },
+                upsert=True
+            ))
+
+        if moves:
+            self.movements.insert_many(moves, ordered=False)
+        self.mac_coll.bulk_write(ops, ordered=False)
+
+    def _flush_postgres(self, rows):
+        if len(rows) < DB_COPY_THRESHOLD:
+            self._flush_postgres_values(rows)
+        else:
+            self._flush_postgres_copy(rows)
+
+    def _flush_postgres_values(self, rows):
+        execute_values(
+            self.cursor, UPSERT_SQL.format(source="VALUES %s"), rows, page_size=DB_COPY_THRESHOLD
+        )
+
+    def _flush_postgres_copy(self, rows):
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        buf.seek(0)
+
+        self.cursor.execute("""
+        CREATE TEMP TABLE stage_mac (
+            mac TEXT,
+            device TEXT,
+            interface TEXT,
+            seen TIMESTAMP
+        ) ON COMMIT DROP;
+        """)
+        # csv.writer leaves '' unquoted, which COPY would read as NULL
+        self.cursor.copy_expert(
+            "COPY stage_mac FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (mac, device, interface))", buf
+        )
+        self.cursor.execute(UPSERT_SQL.format(source="SELECT mac, device, interface, seen FROM stage_mac"))
+        self.cursor.execute("DROP TABLE stage_mac;")
 
     def commit(self):
+        self.flush()
         if DB_BACKEND == "postgres":
             self.conn.commit()
 
@@ -15,17 +15,26 @@ limitations under the License.
 """
 
 import os
+import re
+import sys
 from dotenv import load_dotenv
 from tabulate import tabulate
 import argparse
 from datetime import datetime
+from collections import defaultdict
+from functools import lru_cache
 from db_backend import MACStorage
 
 load_dotenv()
 
+# Separators stripped from user-supplied MACs
+_MAC_STRIP = str.maketrans("", "", "-:.")
+
+@lru_cache(maxsize=1 << 16)
 def normalize_mac(mac_input):
-    return mac_input.lower().replace("-", "").replace(":", "").replace(".", "")
+    return mac_input.lower().translate(_MAC_STRIP)
 
+@lru_cache(maxsize=1 << 16)
 def format_mac(mac):
     mac = normalize_mac(mac)
     return ":".join(mac[i:i+2] for i in range(0, len(mac), 2))
@@ -36,14 +45,10 @@ def search_mac_partial(store: MACStorage, mac_fragment: str, show_history: bool)
 
     if db_backend == "postgres":
         import psycopg2
+        store.prepare_lookups()
         conn = store.conn
         cursor = conn.cursor()
-        cursor.execute("""
-            SELECT mac, device, interface, first_seen, last_seen
-            FROM mac_addresses
-            WHERE REPLACE(REPLACE(REPLACE(mac, ':', ''), '-', ''), '.', '') ILIKE %s
-            ORDER BY last_seen DESC
-        """, (f"%{mac_fragment}%",))
+        cursor.execute("EXECUTE mac_search(%s)", (f"%{mac_fragment}%",))
         rows = cursor.fetchall()
 
         if not rows:
@@ -54,28 +59,21 @@ def search_mac_partial(store: MACStorage, mac_fragment: str, show_history: bool)
         print(tabulate(rows, headers=["MAC", "Device", "Interface", "First Seen", "Last Seen"]))
 
         if show_history:
+            cursor.execute("EXECUTE mac_history(%s)", ([mac for mac, *_ in rows],))
+            histories = defaultdict(list)
+            for mac, *movement in cursor.fetchall():
+                histories[mac].append(movement)
+
             for mac, *_ in rows:
-                cursor.execute("""
-                    SELECT from_device, from_if, to_device, to_if, moved_at
-                    FROM mac_movements
-                    WHERE mac = %s
-                    ORDER BY moved_at DESC
-                """, (mac,))
-                history = cursor.fetchall()
+                history = histories[mac]
                 if history:
                     print(f"\nHistory for {mac}:")
                     print(tabulate(history, headers=["From Device", "From IF", "To Device", "To IF", "Moved At"]))
 
     elif db_backend == "mongo":
-        macs = store.mac_coll.find({
-            "$expr": {
-                "$regexMatch": {
-                    "input": {"$replaceAll": {"input": "$mac", "find": ":", "replacement": ""}},
-                    "regex": mac_fragment,
-                    "options": "i"
-                }
-            }
-        }).sort("last_seen", -1)
+        macs = store.mac_coll.find(
+            {"mac_norm": {"$regex": re.escape(mac_fragment)}}
+        ).sort("last_seen", -1)
 
         mac_list = list(macs)
 
@@ -91,13 +89,18 @@ def search_mac_partial(store: MACStorage, mac_fragment: str, show_history: bool)
         print(tabulate(table, headers=["MAC", "Device", "Interface", "First Seen", "Last Seen"]))
 
         if show_history:
+            movements = store.movements.find(
+                {"mac": {"$in": [d['mac'] for d in mac_list]}}
+            ).sort([("mac", 1), ("moved_at", -1)])
+            histories = defaultdict(list)
+            for m in movements:
+                histories[m['mac']].append(
+                    [m['from_device'], m['from_if'], m['to_device'], m['to_if'], m['moved_at']]
+                )
+
             for d in mac_list:
                 mac = d['mac']
-                movements = store.movements.find({"mac": mac}).sort("moved_at", -1)
-                history = [
-                    [m['from_device'], m['from_if'], m['to_device'], m['to_if'], m['moved_at']]
-                    for m in movements
-                ]
+                history = histories[mac]
                 if history:
                     print(f"\nHistory for {mac}:")
                     print(tabulate(history, headers=["From Device", "From IF", "To Device", "To IF", "Moved At"]))
@@ -107,13 +110,23 @@ def search_mac_partial(store: MACStorage, mac_fragment: str, show_history: bool)
 
 def main():
     parser = argparse.ArgumentParser(description="MAC address lookup (PostgreSQL or MongoDB).")
-    parser.add_argument("mac", help="Full or partial MAC address")
+    parser.add_argument("mac", nargs="?", help="Full or partial MAC address")
     parser.add_argument("--history", action="store_true", help="Include movement history")
+    parser.add_argument("--stdin", action="store_true",
+                        help="Read MACs from stdin, one per line, over a single connection")
     args = parser.parse_args()
+    if args.mac is None and not args.stdin:
+        parser.error("a MAC is required unless --stdin is given")
 
-    store = MACStorage()
+    store = MACStorage(readonly=True)
     try:
-        search_mac_partial(store, args.mac, args.history)
+        if args.stdin:
+            for line in sys.stdin:
+                mac = line.strip()
+                if mac:
+                    search_mac_partial(store, mac, args.history)
+        else:
+            search_mac_partial(store, args.mac, args.history)
     finally:
         store.close()
 
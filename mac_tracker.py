@@ -15,14 +15,23 @@ limitations under the License.
 """
 import os
 import sys
+import json
+import queue
+import atexit
+import argparse
+import time
 import logging
 import threading
 import pynetbox
-from queue import Queue
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 from pysnmp.hlapi import *
+from pysnmp.proto.rfc1905 import NoSuchObject, NoSuchInstance, EndOfMibView
 from db_backend import MACStorage
 
 load_dotenv()
@@ -32,6 +41,20 @@ NETBOX_URL = os.getenv("NETBOX_URL")
 NETBOX_TOKEN = os.getenv("NETBOX_TOKEN")
 THREAD_COUNT = int(os.getenv("THREAD_COUNT", 10))
 
+# NetBox device list is reused between runs for this many seconds; keep it
+# longer than the run schedule and use --refresh after inventory changes
+DEVICE_CACHE_PATH = os.getenv("DEVICE_CACHE_PATH", "netbox_devices.json")
+DEVICE_CACHE_TTL = int(os.getenv("DEVICE_CACHE_TTL", 86400))
+
+# Devices requested per NetBox API page
+NETBOX_PAGE_SIZE = int(os.getenv("NETBOX_PAGE_SIZE", 250))
+
+# Per-device ifIndex -> ifName maps are reused between runs for this many
+# seconds, or until sysUpTime shows the device has rebooted; keep it longer
+# than the run schedule
+IFNAME_CACHE_PATH = os.getenv("IFNAME_CACHE_PATH", "ifname_cache.json")
+IFNAME_CACHE_TTL = int(os.getenv("IFNAME_CACHE_TTL", 86400))
+
 # SNMP Version and Credentials
 SNMP_VERSION = os.getenv("SNMP_VERSION", "v2c").lower()
 SNMP_COMMUNITY = os.getenv("SNMP_COMMUNITY", "public")
@@ -52,25 +75,53 @@ def handle_uncaught_exception(exc_type, exc_value, exc_traceback):
     )
 sys.excepthook = handle_uncaught_exception
 
-file_handler = RotatingFileHandler("mac_tracker.log", maxBytes=5 * 1024 * 1024, backupCount=3)
+file_handler = RotatingFileHandler(
+    "mac_tracker.log", maxBytes=5 * 1024 * 1024, backupCount=3, delay=True
+)
 file_handler.setFormatter(log_formatter)
-logger.addHandler(file_handler)
 
 console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
-logger.addHandler(console_handler)
+
+# Worker threads only enqueue records; a single listener thread writes them
+log_queue = queue.Queue(-1)
+logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, file_handler, console_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # SNMP OIDs
 BRIDGE_MIB_PORT_OID = '1.3.6.1.2.1.17.4.3.1.2'
+BRIDGE_MIB_PORT_PREFIX = tuple(int(part) for part in BRIDGE_MIB_PORT_OID.split('.'))
 PORT_MAP_OID = '1.3.6.1.2.1.17.1.4.1.2'
 IFINDEX_TO_NAME_OID = '1.3.6.1.2.1.31.1.1.1.1'
+SYS_UPTIME_OID = '1.3.6.1.2.1.1.3.0'
+SYS_UPTIME = tuple(int(part) for part in SYS_UPTIME_OID.split('.'))
+
+# Walked tables, built once; responses are left as raw OIDs (lookupMib=False)
+# so pysnmp skips MIB resolution for every returned varbind
+BRIDGE_MIB_PORT = ObjectType(ObjectIdentity(BRIDGE_MIB_PORT_OID))
+
+# Varbinds requested per GETBULK or multi-OID GET PDU; lower it for devices
+# that drop large responses
+SNMP_MAX_REPETITIONS = int(os.getenv("SNMP_MAX_REPETITIONS", 50))
 
-# NetBox API
+# NetBox API, over one keep-alive session with a connection pool
 nb = pynetbox.api(NETBOX_URL, token=NETBOX_TOKEN)
+nb_adapter = HTTPAdapter(
+    pool_connections=THREAD_COUNT,
+    pool_maxsize=THREAD_COUNT,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504))
+)
+nb.http_session = requests.Session()
+nb.http_session.mount("https://", nb_adapter)
+nb.http_session.mount("http://", nb_adapter)
 
 def get_snmp_auth():
-    if SNMP_VERSION == "v2c":
+    if SNMP_VERSION == "v1":
         return CommunityData(SNMP_COMMUNITY, mpModel=0)
+    elif SNMP_VERSION == "v2c":
+        return CommunityData(SNMP_COMMUNITY, mpModel=1)
     elif SNMP_VERSION == "v3":
         auth_proto_map = {
             "SHA": usmHMACSHAAuthProtocol,
@@ -88,96 +139,317 @@ def get_snmp_auth():
             privProtocol=priv_proto_map.get(SNMP_V3_PRIV_PROTO, usmAesCfb128Protocol)
         )
     else:
-        raise ValueError("Unsupported SNMP_VERSION. Use 'v2c' or 'v3'.")
+        raise ValueError("Unsupported SNMP_VERSION. Use 'v1', 'v2c' or 'v3'.")
 
-def snmp_walk(ip, oid):
-    auth = get_snmp_auth()
-    try:
-        for (errInd, errStat, errIdx, varBinds) in nextCmd(
-            SnmpEngine(),
-            auth,
-            UdpTransportTarget((ip, 161), timeout=2, retries=1),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid)),
-            lexicographicMode=False
-        ):
-            if errInd:
-                logger.warning(f"[{ip}] SNMP error: {errInd}")
-                break
-            elif errStat:
-                logger.warning(f"[{ip}] SNMP error: {errStat.prettyPrint()} at {errIdx}")
-                break
+# One SnmpEngine per worker thread, reused for every device that thread scans
+_snmp_local = threading.local()
+_snmp_engines = []
+
+def get_snmp_engine():
+    if not hasattr(_snmp_local, "engine"):
+        _snmp_local.engine = SnmpEngine()
+        _snmp_local.auth = get_snmp_auth()
+        _snmp_engines.append(_snmp_local.engine)
+    return _snmp_local.engine, _snmp_local.auth
+
+def close_snmp_engines():
+    while _snmp_engines:
+        engine = _snmp_engines.pop()
+        if engine.transportDispatcher:
+            engine.transportDispatcher.closeDispatcher()
+
+class SNMPSession:
+    # Walks against one device, sharing the calling thread's engine
+    def __init__(self, ip):
+        self.ip = ip
+        self.engine, self.auth = get_snmp_engine()
+        self.transport = UdpTransportTarget((ip, 161), timeout=2, retries=1)
+        self.context = ContextData()
+
+    def _walk(self, object_type):
+        # Yields one varbind row per table entry until the walk ends or
+        # fails; pysnmp's sync commands split each response PDU into rows
+        ip = self.ip
+        try:
+            if SNMP_VERSION == "v1":
+                # SNMPv1 has no GETBULK
+                responses = nextCmd(
+                    self.engine,
+                    self.auth,
+                    self.transport,
+                    self.context,
+                    object_type,
+                    lexicographicMode=False,
+                    lookupMib=False
+                )
             else:
-                for varBind in varBinds:
-                    yield varBind
-    except Exception as e:
-        logger.error(f"[{ip}] SNMP walk exception: {e}")
+                responses = bulkCmd(
+                    self.engine,
+                    self.auth,
+                    self.transport,
+                    self.context,
+                    0, SNMP_MAX_REPETITIONS,
+                    object_type,
+                    lexicographicMode=False,
+                    lookupMib=False
+                )
+            for (errInd, errStat, errIdx, varBinds) in responses:
+                if errInd:
+                    logger.warning("[%s] SNMP error: %s", ip, errInd)
+                    break
+                elif errStat:
+                    logger.warning("[%s] SNMP error: %s at %s", ip, errStat.prettyPrint(), errIdx)
+                    break
+                else:
+                    yield varBinds
+        except Exception as e:
+            logger.error("[%s] SNMP walk exception: %s", ip, e)
+
+    def walk_bridge_mib(self):
+        # Forwarding table as parallel lists of raw 6-byte MACs and bridge
+        # ports
+        macs, ports = [], []
+        prefix_len = len(BRIDGE_MIB_PORT_PREFIX)
+        for varBinds in self._walk(BRIDGE_MIB_PORT):
+            for oid, val in varBinds:
+                # GETBULK can end a response with endOfMibView or with rows
+                # past the end of the table
+                if isinstance(val, (NoSuchObject, NoSuchInstance, EndOfMibView)):
+                    continue
+                index = oid.asTuple()
+                if index[:prefix_len] != BRIDGE_MIB_PORT_PREFIX:
+                    continue
+                macs.append(bytes(index[-6:]))
+                ports.append(int(val))
+        return macs, ports
+
+    def _get_pdu(self, oids):
+        # One GET for the given OIDs; returns its varbinds, or None on failure
+        ip = self.ip
+        try:
+            errInd, errStat, errIdx, varBinds = next(getCmd(
+                self.engine,
+                self.auth,
+                self.transport,
+                self.context,
+                *[ObjectType(ObjectIdentity(oid)) for oid in oids],
+                lookupMib=False
+            ))
+        except Exception as e:
+            logger.error("[%s] SNMP get exception: %s", ip, e)
+            return None
+        if errInd:
+            logger.warning("[%s] SNMP error: %s", ip, errInd)
+            return None
+        elif errStat:
+            # SNMPv1 fails the whole PDU if any one OID is missing, so retry
+            # the rest individually; a lone missing OID is just skipped
+            if SNMP_VERSION == "v1" and errStat.prettyPrint() == "noSuchName":
+                if len(oids) == 1:
+                    return None
+                varBinds = []
+                for oid in oids:
+                    varBinds.extend(self._get_pdu([oid]) or [])
+                return varBinds
+            logger.warning("[%s] SNMP error: %s at %s", ip, errStat.prettyPrint(), errIdx)
+            return None
+        return varBinds
+
+    def get(self, oids):
+        # Fetch specific instances, packing several OIDs into each GET PDU.
+        # A failed PDU only loses its own OIDs, not the batches after it.
+        for i in range(0, len(oids), SNMP_MAX_REPETITIONS):
+            varBinds = self._get_pdu(oids[i:i + SNMP_MAX_REPETITIONS])
+            if varBinds is None:
+                continue
+            for oid, val in varBinds:
+                if not isinstance(val, (NoSuchObject, NoSuchInstance, EndOfMibView)):
+                    yield oid, val
+
+_ifname_cache = {}
+
+def load_ifname_cache():
+    try:
+        with open(IFNAME_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+    if not isinstance(cache, dict):
+        return
+    for ip, entry in cache.items():
+        # A malformed entry is just a cache miss for that device
+        try:
+            _ifname_cache[ip] = {
+                "sysuptime": int(entry["sysuptime"]),
+                "fetched_at": float(entry["fetched_at"]),
+                "names": {int(ifindex): str(name) for ifindex, name in entry["names"].items()},
+            }
+        except (KeyError, TypeError, AttributeError, ValueError):
+            continue
+
+def save_ifname_cache():
+    try:
+        with open(IFNAME_CACHE_PATH, "w") as f:
+            json.dump(_ifname_cache, f)
+    except OSError as e:
+        logger.warning("Could not write ifName cache %s: %s", IFNAME_CACHE_PATH, e)
+
+def get_ifname_map(session, uptime, ifindexes):
+    now = time.time()
+    entry = _ifname_cache.get(session.ip)
+    if (entry is None or uptime is None or uptime < entry["sysuptime"]
+            or now - entry["fetched_at"] >= IFNAME_CACHE_TTL):
+        entry = {"sysuptime": uptime, "fetched_at": now, "names": {}}
+
+    names = entry["names"]
+    missing = [ifindex for ifindex in ifindexes if ifindex not in names]
+    for oid, val in session.get([f"{IFINDEX_TO_NAME_OID}.{i}" for i in missing]):
+        names[oid.asTuple()[-1]] = val.prettyPrint()
+
+    if uptime is not None:
+        entry["sysuptime"] = uptime
+        _ifname_cache[session.ip] = entry
+    return names
 
 def get_mac_table(ip):
-    mac_table, port_map, ifindex_map = {}, {}, {}
+    # Returns parallel lists of MACs and their interface names
+    port_map, port_names = {}, {}
+    session = SNMPSession(ip)
+
+    # Walk the forwarding table first so only the bridge ports and ifIndexes
+    # that actually carry MACs are looked up afterwards. MACs stay as raw
+    # bytes until we know they map to an interface.
+    fdb_macs, fdb_ports = session.walk_bridge_mib()
+
+    # Port 0 is the bridge itself and has no dot1dBasePort entry
+    ports = sorted({bridge_port for bridge_port in fdb_ports if bridge_port > 0})
+    if ports:
+        # sysUpTime rides along in the first GET to validate the ifName cache
+        uptime = None
+        oids = [SYS_UPTIME_OID] + [f"{PORT_MAP_OID}.{p}" for p in ports]
+        for oid, val in session.get(oids):
+            index = oid.asTuple()
+            if index == SYS_UPTIME:
+                uptime = int(val)
+            else:
+                port_map[index[-1]] = int(val)
 
-    for oid, val in snmp_walk(ip, PORT_MAP_OID):
-        bridge_port = int(oid.prettyPrint().split('.')[-1])
-        port_map[bridge_port] = int(val.prettyPrint())
+        ifindex_map = get_ifname_map(session, uptime, sorted(set(port_map.values())))
+        # Resolve bridge port -> interface name once per port, not per MAC
+        port_names = {
+            bridge_port: ifindex_map.get(ifindex, f"ifIndex-{ifindex}")
+            for bridge_port, ifindex in port_map.items()
+        }
 
-    for oid, val in snmp_walk(ip, IFINDEX_TO_NAME_OID):
-        ifindex = int(oid.prettyPrint().split('.')[-1])
-        ifindex_map[ifindex] = val.prettyPrint()
+    macs, interfaces = [], []
+    for mac, bridge_port in zip(fdb_macs, fdb_ports):
+        interface = port_names.get(bridge_port)
+        if interface is not None:
+            macs.append(mac.hex(':'))
+            interfaces.append(interface)
 
-    for oid, val in snmp_walk(ip, BRIDGE_MIB_PORT_OID):
-        mac_oid = oid.prettyPrint()
-        bridge_port = int(val.prettyPrint())
-        mac_raw = mac_oid.split('.')[-6:]
-        mac = ':'.join(f"{int(b):02x}" for b in mac_raw)
+    return macs, interfaces
 
-        if bridge_port in port_map:
-            ifindex = port_map[bridge_port]
-            interface = ifindex_map.get(ifindex, f"ifIndex-{ifindex}")
-            mac_table[mac] = interface
+def fetch_targets():
+    # Only active devices with an IP, and only the fields used below. Pages
+    # are requested lazily, so devices are yielded as each page arrives.
+    devices = nb.dcim.devices.filter(
+        has_primary_ip=True, status="active", fields="name,primary_ip4",
+        limit=NETBOX_PAGE_SIZE
+    )
+    for dev in devices:
+        if dev.primary_ip4:
+            ip = dev.primary_ip4.address.split("/")[0]
+            yield dev.name, ip
 
-    return mac_table
+def load_cached_targets():
+    try:
+        if time.time() - os.path.getmtime(DEVICE_CACHE_PATH) < DEVICE_CACHE_TTL:
+            with open(DEVICE_CACHE_PATH) as f:
+                targets = [tuple(t) for t in json.load(f)]
+            logger.info("Using cached device list from %s", DEVICE_CACHE_PATH)
+            return targets
+    except (OSError, ValueError):
+        pass
+    return None
 
-def worker(queue, store: MACStorage):
-    while not queue.empty():
-        device, ip = queue.get()
-        try:
-            logger.info(f"[{device}] Starting scan of {ip}")
-            mac_table = get_mac_table(ip)
-            for mac, interface in mac_table.items():
-                store.upsert_mac(mac, device, interface)
-            logger.info(f"[{device}] Completed scan of {ip}")
-        except Exception as e:
-            logger.exception(f"[{device}] Error during processing")
-        finally:
-            queue.task_done()
+def get_targets(refresh=False):
+    cached = None if refresh else load_cached_targets()
+    if cached is not None:
+        yield from cached
+        return
+
+    targets = []
+    for target in fetch_targets():
+        targets.append(target)
+        yield target
+
+    try:
+        with open(DEVICE_CACHE_PATH, "w") as f:
+            json.dump(targets, f)
+    except OSError as e:
+        logger.warning("Could not write device cache %s: %s", DEVICE_CACHE_PATH, e)
+
+def scan_device(target):
+    device, ip = target
+    try:
+        logger.info("[%s] Starting scan of %s", device, ip)
+        macs, interfaces = get_mac_table(ip)
+        logger.info("[%s] Completed scan of %s", device, ip)
+    except Exception as e:
+        logger.exception("[%s] Error during processing", device)
+        macs, interfaces = [], []
+    return device, macs, interfaces
+
+def store_scans(store, futures):
+    # Results are dropped once stored, so memory doesn't grow with the run
+    for future in futures:
+        device, macs, interfaces = future.result()
+        store.upsert_macs_bulk(device, macs, interfaces)
+        store.commit()
 
 def main():
+    parser = argparse.ArgumentParser(description="Track MAC address locations via SNMP and NetBox.")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Ignore the cached NetBox device list and ifName maps")
+    args = parser.parse_args()
+
     logger.info("=== MAC Tracker Run Started ===")
     store = MACStorage()
     try:
-        q = Queue()
-        devices = nb.dcim.devices.all()
-        for dev in devices:
-            if dev.primary_ip4:
-                ip = dev.primary_ip4.address.split("/")[0]
-                q.put((dev.name, ip))
-
-        threads = []
-        for _ in range(min(THREAD_COUNT, q.qsize())):
-            t = threading.Thread(target=worker, args=(q, store))
-            t.start()
-            threads.append(t)
-
-        q.join()
+        if not args.refresh:
+            load_ifname_cache()
 
-        for t in threads:
-            t.join()
+        # SNMP walks run in the pool, starting while NetBox is still being
+        # paged; storage stays on the main thread and each device is
+        # committed as soon as its walk finishes
+        with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+            pending = set()
+            try:
+                for target in get_targets(args.refresh):
+                    pending.add(executor.submit(scan_device, target))
+                    # Keep only a short queue in flight and store finished
+                    # scans while NetBox is still being paged
+                    if len(pending) >= THREAD_COUNT * 2:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        store_scans(store, done)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    store_scans(store, done)
+            except BaseException:
+                # Drop queued scans so only the ones already running are
+                # waited on before the error is reported
+                for future in pending:
+                    future.cancel()
+                raise
 
         store.commit()
+        save_ifname_cache()
         logger.info("=== MAC Tracker Run Completed ===")
     except Exception as e:
         logger.exception("Fatal error in main")
     finally:
+        close_snmp_engines()
         store.close()
 
 if __name__ == "__main__":